@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 
 import os
-from subprocess import run, PIPE, check_output
+from subprocess import run, PIPE, check_output, CalledProcessError
 from argparse import ArgumentParser
-import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import json
+import heapq
+from array import array
+import hashlib
+import filecmp
+import tempfile
 import shlex
-import csv
 import sys
 
 version = f"""\
@@ -15,7 +21,7 @@ Martin Pickett
 
 help = f"""\
 Calculates frame-by-frame VMAF score for a distorted video relative to a 
-reference video and saves results in a CSV file.
+reference video and saves results in a JSON file.
 
 Usage: {os.path.basename(__file__)} [OPTIONS...] DISTORTED-VIDEO(S)
 
@@ -31,6 +37,9 @@ Input Options:
                             crop value of distorted video relative to reference
                                 video. TOP:BOTTOM:LEFT:RIGHT crop format also
                                 accepted
+      --skip-identical      skip calculation for distorted videos identical to
+                                the reference and report assumed perfect
+                                scores instead of measured ones
 
 Additional Quality Metrics:
       --psnr                enables computing PSNR
@@ -43,7 +52,18 @@ VMAF options:
       --model PATH          path to VMAF model 
                              (default: /usr/local/share/model/vmaf_v0.6.1.json)
       --subsample INT       set interval for frame subsampling (default: 1)
-      --threads INT         set the number of threads used (default: 1)
+      --fast                only compute quality metrics on every 5th frame
+                                (same as --subsample 5). Much faster, but
+                                less accurate, useful for rough comparisons
+      --threads INT         set the number of threads used
+                                (default: number of logical cores)
+      --parallel INT        number of FFmpeg jobs to run simultaneously, each
+                                with a share of the logical cores as threads
+
+Summary options:
+      --approximate-percentile
+                            estimate the 5th percentile in constant memory
+                                instead of keeping every frame's score
 """
 
 helpBottom = f"""\
@@ -55,6 +75,147 @@ Other options:
 Requires FFprobe and FFmpeg with VMAF support.
 """
 
+# FFprobe results from previous runs
+# Key: absolute path; Value: [size, mtime_ns, width, height, duration]
+# XDG_CACHE_HOME is ignored when empty or relative, as the XDG spec requires
+cacheHome = os.environ.get("XDG_CACHE_HOME") or ""
+if not os.path.isabs(cacheHome):
+	cacheHome = os.path.expanduser("~/.cache")
+probeCachePath = os.path.join(cacheHome, "video-quality", "probe.json")
+probeCache = {}
+probeCacheChanged = False
+
+def loadProbeCache():
+	try:
+		with open(probeCachePath, "r") as cacheFile:
+			cache = json.load(cacheFile)
+	except (OSError, ValueError):
+		return
+	if isinstance(cache, dict):
+		probeCache.update(cache)
+
+def saveProbeCache():
+	# Only write when something new was probed, and to a unique temporary file
+	# first so concurrent runs never see a partial cache
+	if not probeCacheChanged:
+		return
+	try:
+		os.makedirs(os.path.dirname(probeCachePath), exist_ok=True)
+		fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(probeCachePath), suffix=".tmp")
+	except OSError:
+		return
+	try:
+		with os.fdopen(fd, "w") as cacheFile:
+			json.dump(probeCache, cacheFile)
+		os.replace(tmpPath, probeCachePath)
+	except OSError:
+		try:
+			os.remove(tmpPath)
+		except OSError:
+			pass
+
+class ScanError(Exception):
+	# A video file FFprobe could not report width, height and duration for
+	def __init__(self, path, reason):
+		super().__init__(f"Error, could not scan video file {path}: {reason}")
+
+# FFprobe subprocess options. Python creates its file descriptors as
+# non-inheritable, so there is nothing to gain from closing every possible
+# descriptor before each exec
+probeOptions = dict(stderr=PIPE, close_fds=False)
+
+@lru_cache(maxsize=None)
+def probe(path, st):
+	global probeCacheChanged
+
+	# Reuse cached values if the file is unchanged since it was last probed
+	key = os.path.abspath(path)
+	entry = probeCache.get(key)
+	if isinstance(entry, list) and len(entry) == 5 and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+		try:
+			return int(entry[2]), int(entry[3]), float(entry[4])
+		except (TypeError, ValueError):
+			pass
+
+	# Width, height and duration of the first video stream in a single FFprobe call
+	try:
+		out = check_output([ "ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height:format=duration", "-of", "default=noprint_wrappers=1:nokey=1", path ], **probeOptions)
+	except CalledProcessError as e:
+		raise ScanError(path, e.stderr.decode(errors="replace").strip())
+
+	# Audio only files or unknown durations do not give three numbers
+	try:
+		width, height, duration = out.decode(errors="replace").split()
+		width, height, duration = int(width), int(height), float(duration)
+	except ValueError:
+		raise ScanError(path, f"unexpected FFprobe output \"{' '.join(out.decode(errors='replace').split())}\"")
+	probeCache[key] = [st.st_size, st.st_mtime_ns, width, height, duration]
+	probeCacheChanged = True
+	return width, height, duration
+
+def quickHash(path):
+	# Hash of the size and the first and last MiB, cheap even for huge files
+	size = os.path.getsize(path)
+	with open(path, "rb") as videoFile:
+		head = videoFile.read(1 << 20)
+		videoFile.seek(max(0, size - (1 << 20)))
+		tail = videoFile.read()
+	return hashlib.blake2b(head + tail + str(size).encode()).digest()
+
+class PercentileEstimator:
+	# Running count, total and P-square estimate of a single percentile (Jain &
+	# Chlamtac, 1985), using five markers instead of storing every value
+	def __init__(self, p):
+		self.p = p
+		self.count = 0
+		self.total = 0.0
+		self.heights = []
+		self.positions = [1, 2, 3, 4, 5]
+		self.desired = [1, 1 + 2*p, 1 + 4*p, 3 + 2*p, 5]
+		self.increments = [0, p/2, p, (1 + p)/2, 1]
+
+	def add(self, x):
+		self.count += 1
+		self.total += x
+		q = self.heights
+		if len(q) < 5:
+			q.append(x)
+			q.sort()
+			return
+
+		# Find the cell containing x, extending the extreme markers if needed
+		if x < q[0]:
+			q[0] = x
+			k = 0
+		elif x >= q[4]:
+			q[4] = x
+			k = 3
+		else:
+			k = next(i for i in range(4) if x < q[i + 1])
+		n = self.positions
+		for i in range(k + 1, 5):
+			n[i] += 1
+		for i in range(5):
+			self.desired[i] += self.increments[i]
+
+		# Move the middle markers towards their desired positions
+		for i in range(1, 4):
+			d = self.desired[i] - n[i]
+			if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+				d = 1 if d > 0 else -1
+				parabolic = q[i] + d / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+				if q[i - 1] < parabolic < q[i + 1]:
+					q[i] = parabolic
+				else:
+					q[i] += d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+				n[i] += d
+
+	def value(self):
+		# Exact while there are still five values or fewer
+		if self.count <= 5:
+			return self.heights[int(self.p * self.count)]
+		return self.heights[2]
+
 def main():
 	#####################
 	##### ARGUMENTS #####
@@ -67,12 +228,16 @@ def main():
 	parser.add_argument("--duration", type=int)
 	parser.add_argument("--clip-distorted-videos", action="store_true", default=False)
 	parser.add_argument("--crop", type=str)
+	parser.add_argument("--skip-identical", action="store_true", default=False)
 	parser.add_argument("--psnr", action="store_true", default=False)
 	parser.add_argument("--ssim", action="store_true", default=False)
 	parser.add_argument("--ms-ssim", action="store_true", default=False)
 	parser.add_argument("--model", type=str)
 	parser.add_argument("--subsample", type=int)
+	parser.add_argument("--fast", action="store_true", default=False)
 	parser.add_argument("--threads", type=int)
+	parser.add_argument("--parallel", type=int)
+	parser.add_argument("--approximate-percentile", action="store_true", default=False)
 	parser.add_argument("-h", "--help", action="store_true", default=False)
 	parser.add_argument("--full-help", action="store_true", default=False)
 	parser.add_argument("--version", action="store_true", default=False)
@@ -107,8 +272,7 @@ def main():
 	# Check existence of FFmpeg
 	tools = {
 		"FFmpeg": ["ffmpeg", "-version"],
-		"FFprobe": ["ffprobe", "-version"],
-		"VMAF": ["ffmpeg", "-filters", "|", "grep", "libvmaf"]
+		"FFprobe": ["ffprobe", "-version"]
 	}
 	for tool, command in tools.items():
 		print(f"Verifying \"{tool}\" availability...")
@@ -117,33 +281,59 @@ def main():
 		except:
 			exit(f"\"{tool}\" not found")
 
+	# Check FFmpeg was built with libvmaf by searching its list of filters
+	print("Verifying \"VMAF\" availability...")
+	try:
+		filters = check_output(["ffmpeg", "-hide_banner", "-filters"], stderr=PIPE)
+	except:
+		filters = b""
+	if b"libvmaf" not in filters:
+		exit("\"VMAF\" not found")
+
 
 	##########################
 	##### SCANNING MEDIA #####
 	##########################
 	print("Scanning media...")
 	
-	# Check video file names
-	if not os.path.exists(args.reference):
+	# Check video file names, keeping each file's stat for the probe cache
+	try:
+		refStat = os.stat(args.reference)
+	except OSError:
 		exit(f"Error, reference video file {args.reference} does not exist")
+
+	# List each directory of distorted videos once. The stat of a directory entry
+	# is free on Windows and otherwise costs the single stat the probe needs
+	directoryListings = {}
+	distStats = []
 	for f in args.file:
-		if not os.path.exists(f):
+		directory, name = os.path.split(f)
+		directory = directory or "."
+		if directory not in directoryListings:
+			try:
+				with os.scandir(directory) as entries:
+					directoryListings[directory] = {e.name: e for e in entries}
+			except OSError:
+				directoryListings[directory] = {}
+
+		# Names can differ from the listing (case-insensitive or Unicode normalising
+		# filesystems, unreadable directories, trailing slashes), so stat misses
+		entry = directoryListings[directory].get(name)
+		try:
+			distStats.append(entry.stat() if entry else os.stat(f))
+		except OSError:
 			exit(f"Error, distorted video file {f} does not exist")
 	
-	# Reference video length, width & height
-	refLength = float(check_output([ "ffprobe", "-v", "quiet", "-i", args.reference, "-select_streams", "v:0", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1" ]))
-	refWidth = int(check_output([ "ffprobe", "-v", "error", "-i", args.reference, "-select_streams", "v:0", "-show_entries", "stream=width", "-of", "default=noprint_wrappers=1:nokey=1" ]))
-	refHeight = int(check_output([ "ffprobe", "-v", "error", "-i", args.reference, "-select_streams", "v:0", "-show_entries", "stream=height", "-of", "default=noprint_wrappers=1:nokey=1" ]))
-
-	# Distorted videos length, width & height	
-	numInputs = len(args.file)
-	distLength = [0]*numInputs
-	distWidth = [0]*numInputs
-	distHeight = [0]*numInputs
-	for i, f in enumerate(args.file):
-		distLength[i] = float(check_output([ "ffprobe", "-v", "quiet", "-i", f, "-select_streams", "v:0", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1" ]))
-		distWidth[i] = int(check_output([ "ffprobe", "-v", "error", "-i", f, "-select_streams", "v:0", "-show_entries", "stream=width", "-of", "default=noprint_wrappers=1:nokey=1" ]))
-		distHeight[i] = int(check_output([ "ffprobe", "-v", "error", "-i", f, "-select_streams", "v:0", "-show_entries", "stream=height", "-of", "default=noprint_wrappers=1:nokey=1" ]))
+	# Reference and distorted videos length, width & height, probed concurrently
+	loadProbeCache()
+	try:
+		with ThreadPoolExecutor(max_workers=min(8, len(args.file) + 1)) as executor:
+			results = list(executor.map(probe, [args.reference] + args.file, [refStat] + distStats))
+	except ScanError as e:
+		exit(str(e))
+	saveProbeCache()
+	refWidth, refHeight, refLength = results[0]
+	distWidth, distHeight, distLength = zip(*results[1:])
 
 	# detirmine if reference video is too big (> 4K) and which vmaf model to use
 	vmafWidth = 0
@@ -182,11 +372,9 @@ def main():
 	if args.crop:
 		max_x = refWidth/4
 		max_y = refHeight/4
-		pattern = re.compile("([0-9]+):([0-9]+):([0-9]+):([0-9]+)")
-		match = pattern.match(args.crop)
-		if match:
-			crop[0], crop[1], crop[2], crop[3] = match.groups()
-			crop = [int(x) for x in crop]
+		parts = args.crop.split(":")
+		if len(parts) == 4 and all(p.isdecimal() for p in parts):
+			crop = [int(x) for x in parts]
 			if crop[2] <= max_x and crop[3] <= max_x and crop[0] <= max_y and crop[1] <= max_y:
 				print("Interpreting crop geometry as TOP:BOTTOM:LEFT:RIGHT values...")
 				width = refWidth - (crop[2] + crop[3])
@@ -215,20 +403,29 @@ def main():
 		if not os.path.exists(args.model):
 			exit(f"Model file does not exists: {args.model}")
 
+	# Fast mode subsamples frames unless an interval is given explicitly
+	if args.fast and not args.subsample:
+		args.subsample = 5
+
+	# Verify number of parallel jobs
+	if args.parallel is not None and args.parallel < 1:
+		exit(f"Invalid number of parallel jobs: {args.parallel}")
+
 	# Quality metrics dictionary
-	# Key: Display Name; Value: [command, csv_name, csv_column, accuracy, values]
-	qualityMetrics = {"VMAF": ["", "vmaf", 0, 2]}
+	# Key: Display Name; Value: [command, log_name, log_column, accuracy, perfect_score]
+	# (perfect PSNR is libvmaf's 8-bit cap of 60 dB, as bit depth is not probed)
+	qualityMetrics = {"VMAF": ["", "vmaf", 0, 2, 100.0]}
 	if args.psnr:
-		qualityMetrics["PSNR"] = [":psnr=1", "psnr", 0, 2]
+		qualityMetrics["PSNR"] = [":psnr=1", "psnr", 0, 2, 60.0]
 	if args.ssim:
-		qualityMetrics["SSIM"] = [":ssim=1", "ssim", 0, 4]
+		qualityMetrics["SSIM"] = [":ssim=1", "ssim", 0, 4, 1.0]
 	if args.ms_ssim:
-		qualityMetrics["MS-SSIM"] = [":ms_ssim=1", "ms_ssim", 0, 4]
+		qualityMetrics["MS-SSIM"] = [":ms_ssim=1", "ms_ssim", 0, 4, 1.0]
 		
 	# Verify output files do not already exist
 	vmafOut = []
 	for f in args.file:
-		vmafOut.append(os.path.splitext(os.path.basename(f))[0] + "-quality.csv")
+		vmafOut.append(os.path.splitext(os.path.basename(f))[0] + "-quality.json")
 		if not args.dry_run and os.path.exists(vmafOut[-1]):
 			exit(f"Output file already exists: {vmafOut[-1]}")
 
@@ -237,93 +434,151 @@ def main():
 	##### VMAF CALCULATION #####
 	############################
 	
-	# Loop over all inputs
-	for i, f in enumerate(args.file):
+	# Distorted videos identical to an unclipped, uncropped reference can skip
+	# calculation if requested. A quick hash rules out most files before a full
+	# comparison
+	identical = set()
+	if args.skip_identical and not args.dry_run and not args.crop and (args.clip_distorted_videos or not (args.position or args.duration)):
+		refHash = quickHash(args.reference)
+		for i, f in enumerate(args.file):
+			if quickHash(f) == refHash and filecmp.cmp(f, args.reference, shallow=False):
+				print(f"Distorted video \"{f}\" is identical to the reference video, skipping calculation")
+				identical.add(i)
+	remaining = [i for i in range(len(args.file)) if i not in identical]
+
+	# Group distorted videos into batches, one FFmpeg command per batch. The
+	# reference video is only decoded once per batch and split between inputs.
+	# Batches are kept small as a failing input stops its whole batch, and every
+	# input in a batch adds a decoder and a libvmaf instance to the process
+	maxBatchSize = 4
+	numBatches = min(max(args.parallel or 1, -(-len(remaining) // maxBatchSize)), len(remaining))
+	batches = [remaining[b::numBatches] for b in range(numBatches)]
+
+	# Use all logical cores for libvmaf by default, shared between the jobs that
+	# actually run at the same time
+	defaultThreads = not args.threads
+	if defaultThreads:
+		concurrentJobs = max(1, min(args.parallel or 1, numBatches))
+		args.threads = max(1, (os.cpu_count() or 1) // concurrentJobs)
+
+	# Parts of the filter string and FFmpeg command shared by every batch
+	# ---------------------------------------------------------------------
+	#
+	# Reference video filters, before it is split between distorted videos
+	cropString = f"{crop[0]}:{crop[1]}:{crop[2]}:{crop[3]}"
+	if crop[0] < vmafWidth:
+		referenceFilters = f"crop={cropString},scale={vmafWidth}:{vmafHeight}:flags=bicubic:force_original_aspect_ratio=decrease,setpts=PTS-STARTPTS"
+	else:
+		referenceFilters = f"crop={cropString},setpts=PTS-STARTPTS"
+
+	# Optional libvmaf features
+	vmafOptions = ""
+	if args.model:
+		vmafOptions += f":model_path={args.model}"
+	if args.subsample:
+		vmafOptions += f":n_subsample={args.subsample}"
+
+	# Optional quality metrics
+	for key, value in qualityMetrics.items():
+		if not key == "VMAF":
+			vmafOptions += value[0]
+
+	# FFmpeg command beginning, progress only shown when someone can see it
+	ffmpegBase = [ "ffmpeg", "-hide_banner", "-v", "fatal" ]
+	if sys.stderr.isatty() and not args.parallel:
+		ffmpegBase += [ "-stats" ]
+	else:
+		ffmpegBase += [ "-nostats" ]
+
+	# FFmpeg command distorted input clipping
+	distortedClip = []
+	if args.position and args.clip_distorted_videos:
+		distortedClip += [ "-ss", str(args.position) ]
+	if args.duration and args.clip_distorted_videos:
+		distortedClip += [ "-t", str(args.duration) ]
+
+	# FFmpeg command reference input
+	referenceInput = []
+	if args.position:
+		referenceInput += [ "-ss", str(args.position) ]
+	if args.duration:
+		referenceInput += [ "-t", str(args.duration) ]
+	referenceInput += [ "-i", args.reference ]
+
+	# FFmpeg command output
+	outputCommands = [ "-an", "-f", "null", "-" ]
+
+	# Loop over all batches
+	jobs = []
+	for batch in batches:
 		# FFmpeg Filter String
 		# --------------------
 		# 
-		# Distorted video filters
-		if distWidth[i] < vmafWidth:
-			distortedVideoPrep = f"[0:v]scale={vmafWidth}:{vmafHeight}:flags=bicubic:force_original_aspect_ratio=decrease,setpts=PTS-STARTPTS[dist]; "
+		# Distorted video filters, inputs 0 to len(batch) - 1
+		distortedVideoPrep = ""
+		for j, i in enumerate(batch):
+			if distWidth[i] < vmafWidth:
+				distortedVideoPrep += f"[{j}:v]scale={vmafWidth}:{vmafHeight}:flags=bicubic:force_original_aspect_ratio=decrease,setpts=PTS-STARTPTS[dist{j}]; "
+			else:
+				distortedVideoPrep += f"[{j}:v]setpts=PTS-STARTPTS[dist{j}]; "
+
+		# Reference video filters, last input split once per distorted video
+		splitOutputs = "".join(f"[ref{j}]" for j in range(len(batch)))
+		referenceVideoPrep = f"[{len(batch)}:v]{referenceFilters},split={len(batch)}{splitOutputs}; "
+
+		# VMAF filter strings, one per distorted video. Default threads are shared
+		# between the libvmaf instances of the batch
+		if defaultThreads:
+			batchThreads = max(1, args.threads // len(batch))
 		else:
-			distortedVideoPrep = "[0:v]setpts=PTS-STARTPTS[dist]; "
-
-
-		# Reference video filters
-		cropString = f"{crop[0]}:{crop[1]}:{crop[2]}:{crop[3]}"
-		if crop[0] < vmafWidth:
-			referenceVideoPrep = f"[1:v]crop={cropString},scale={vmafWidth}:{vmafHeight}:flags=bicubic:force_original_aspect_ratio=decrease,setpts=PTS-STARTPTS[ref]; "
-		else:
-			referenceVideoPrep = f"[1:v]crop={cropString},setpts=PTS-STARTPTS[ref]; "
-
-
-		# VMAF filter string
-		vmafFilterString = f"[dist][ref]libvmaf=log_fmt=csv:log_path={vmafOut[i]}"
-	
-		# Optional libvmaf features
-		if args.model:
-			vmafFilterString += f":model_path={args.model}"
-		if args.subsample:
-			vmafFilterString += f":n_subsample={args.subsample}"
-		if args.threads:
-			vmafFilterString += f":n_threads={args.threads}"
-
-		# Optional quality metrics
-		for key, value in qualityMetrics.items():
-			if not key == "VMAF":
-				vmafFilterString += value[0]
+			batchThreads = args.threads
+		vmafFilterStrings = [ f"[dist{j}][ref{j}]libvmaf=log_fmt=json:log_path={vmafOut[i]}:n_threads={batchThreads}" + vmafOptions for j, i in enumerate(batch) ]
 
 		# Assemble final filter string
-		filterString = distortedVideoPrep + referenceVideoPrep + vmafFilterString
+		filterString = distortedVideoPrep + referenceVideoPrep + "; ".join(vmafFilterStrings)
 
 
 		# FFmpeg Command Generation
 		#--------------------------
 		#
-		# FFmpeg command beginning
-		ffmpegCommand = [ "ffmpeg", "-hide_banner", "-v", "fatal", "-stats" ]
-	
-		# FFmpeg command distorted input
-		distortedInput = []
-		if args.position and args.clip_distorted_videos:
-			distortedInput += [ "-ss", str(args.position) ]
-		if args.duration and args.clip_distorted_videos:
-			distortedInput += [ "-t", str(args.duration) ]
-		distortedInput += [ "-i", f ]
-		ffmpegCommand += distortedInput
-	
-		# FFmpeg command reference input
-		referenceInput = []
-		if args.position:
-			referenceInput += [ "-ss", str(args.position) ]
-		if args.duration:
-			referenceInput += [ "-t", str(args.duration) ]
-		referenceInput += [ "-i", args.reference ]
-		ffmpegCommand += referenceInput
-
-		# Assemble FFmpeg command	
-		filterInput = [ "-filter_complex", filterString ]
-		ffmpegCommand += filterInput
-	
-		# FFmpeg command output
-		outputCommands = [ "-an", "-f", "null", "-" ]
-		ffmpegCommand += outputCommands
+		ffmpegCommand = list(ffmpegBase)
+		for i in batch:
+			ffmpegCommand += distortedClip + [ "-i", args.file[i] ]
+		ffmpegCommand += referenceInput + [ "-filter_complex", filterString ] + outputCommands
 
 		# Run FFmpeg Command
 		#-------------------
 		#
 		print()
-		print(" ".join(map(lambda x: shlex.quote(x), ffmpegCommand)))
+		print(shlex.join(ffmpegCommand))
 		print()
-		if args.dry_run:
-			continue
-		else:
-			a = run(ffmpegCommand)
+		jobs.append(ffmpegCommand)
 
 	# If dry run end script
 	if args.dry_run:
 		exit()
 
+	# Write perfect scores for distorted videos identical to the reference,
+	# marked as synthetic since libvmaf itself may score identical videos lower
+	for i in identical:
+		with open(vmafOut[i], "w") as jsonFile:
+			metrics = {value[1]: value[4] for value in qualityMetrics.values()}
+			json.dump({"synthetic": True, "frames": [{"frameNum": 0, "metrics": metrics}]}, jsonFile)
+
+	# Run FFmpeg commands, several at once if requested
+	if args.parallel:
+		with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+			completed = list(executor.map(lambda c: run(c, stdout=PIPE, stderr=PIPE), jobs))
+	else:
+		completed = [run(ffmpegCommand) for ffmpegCommand in jobs]
+
+	# Stop if any FFmpeg command failed, showing its error output if captured
+	for a in completed:
+		if a.returncode != 0:
+			if a.stderr:
+				print(a.stderr.decode(errors="replace"), file=sys.stderr)
+			exit(f"FFmpeg failed with exit status {a.returncode}: {shlex.join(a.args)}")
+
 
 	###########################
 	##### POST PROCESSING #####
@@ -335,57 +590,60 @@ def main():
 	fileDictionary = {}
 	for f in vmafOut:
 		# Create empty resultsDictionary
+		# Key: Display Name; Value: [log_name, scores or PercentileEstimator]
 		resultsDictionary = {}
 		for key in qualityMetrics:
-			resultsDictionary[key] = [0,[]]
-
-		# open vmafFile and read as a csv
-		with open(f, "r") as csvFile:
-			csvReader = csv.reader(csvFile, delimiter = ',')
-
-			# extract column header row
-			columnNames = []
-			for row in csvReader:
-				columnNames = row
-				break
-
-			# Find column index for each quality values
-			toRemove = []
-			for key, value in resultsDictionary.items():
-				try:
-					value[0] = columnNames.index(qualityMetrics[key][1])
-				except:
-					print(f"Warning: Could not find {key} in results")
-					toRemove.append(key)
-					
-			# Remove quality metrics not detected in output file
-			for i in toRemove:
-				resultsDictionary.pop(i)
-
-			# Read rest of CSV file and store results
-			for row in csvReader:
-				for value in resultsDictionary.values():
-					q = row[value[0]].strip()
-					try:
-						q = float(q)
-						value[1].append(q)
-					except:
-						pass
-
-			# Store resultsDictionary in fileDictionary
-			fileDictionary[f.replace("-quality.csv","")] = resultsDictionary
+			resultsDictionary[key] = [qualityMetrics[key][1], array("d")]
+
+		# open vmafFile and read as json
+		with open(f, "r") as jsonFile:
+			frames = json.load(jsonFile).get("frames", [])
+
+		# Remove quality metrics not detected in output file
+		toRemove = []
+		for key, value in resultsDictionary.items():
+			if not any(value[0] in frame["metrics"] for frame in frames):
+				print(f"Warning: Could not find {key} in results")
+				toRemove.append(key)
+		for i in toRemove:
+			resultsDictionary.pop(i)
+
+		# Store scores as contiguous doubles, or only feed them to an estimator
+		for value in resultsDictionary.values():
+			if args.approximate_percentile:
+				value[1] = PercentileEstimator(0.05)
+				for frame in frames:
+					if value[0] in frame["metrics"]:
+						value[1].add(frame["metrics"][value[0]])
+			else:
+				value[1] = array("d", (frame["metrics"][value[0]] for frame in frames if value[0] in frame["metrics"]))
+
+		# Release the parsed log before reading the next one
+		del frames
+
+		# Store resultsDictionary in fileDictionary
+		fileDictionary[f.replace("-quality.json","")] = resultsDictionary
 			
 	# Calculate and print quality averages
 	print()
+	syntheticResults = {vmafOut[i].replace("-quality.json","") for i in identical}
 	for filename, results in fileDictionary.items():
-		print(filename)
+		if filename in syntheticResults:
+			print(f"{filename} (identical to reference, perfect scores assumed, not measured)")
+		else:
+			print(filename)
 		for key, value in results.items():
-			if len(value[1]) == 0:
-				continue
-			value[1].sort()
-			meanQuality = sum(value[1]) / len(value[1])
-			nthPercentileIndex = int(0.05 * len(value[1]))
-			nthPercentileValue = value[1][nthPercentileIndex]
+			if args.approximate_percentile:
+				if value[1].count == 0:
+					continue
+				meanQuality = value[1].total / value[1].count
+				nthPercentileValue = value[1].value()
+			else:
+				if len(value[1]) == 0:
+					continue
+				meanQuality = sum(value[1]) / len(value[1])
+				nthPercentileIndex = int(0.05 * len(value[1]))
+				nthPercentileValue = heapq.nsmallest(nthPercentileIndex + 1, value[1])[-1]
 			precision = qualityMetrics[key][3]
 			a = f"Mean Average {key}:".ljust(22)
 			b = f"{meanQuality:<10.{precision}f}".ljust(12)